@@ -1,4 +1,4 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 
 """Cleans up one or many given directories until a given amount of free space is
 available on the device of those directories. See the usage method below for
@@ -30,6 +30,9 @@ Options:
                       wish to have available on the device with the given
                       directories. The default is 51200 MB (50 GB).
 
+  -v, --verbose       Print every removed file. Otherwise only a summary is
+                      printed at the end.
+
 If MIN_AVAIL_SPACE is already available on the device with the given directories
 then this script deletes nothing and exists with a corresponding message.
 
@@ -46,99 +49,165 @@ Examples:
   ./cleanup.py /path/to/my/recordings
   ./cleanup.py -s 12000 /path/to/my/recordings
   ./cleanup.py -s 12000 /path/to/my/recordings /some/other/dir
+  ./cleanup.py -v -s 12000 /path/to/my/recordings
 '''.strip())
 
 
 import sys
 import os
+import stat
 import getopt
+import heapq
+import concurrent.futures
 
-class File:
-    """A simple file class. A File has a path and a modification time. The
-    modification time is stored as seconds since the epoch.
-
-       Usage:
-          >>> f = File('/tmp/foo', 1395506398)
-          >>> f.path
-          '/tmp/foo'
-          >>> f.mtime
-          1395506398
-    """
-
-    def __init__(self, path, mtime):
-        """Creates a File with the given path and modification time."""
-        self.path = path
-        self.mtime = mtime
+# Bound once, as it is called for every removed file.
+_unlink = os.unlink
 
-    def __repr__(self):
-        """Print File('/tmp/foo', 1395506398) as ('/tmp/foo', 1395506398)."""
-        return repr((self.path, self.mtime))
+# Maximal number of files cleanup() removes before it asks the file system
+# again how much space is available, even if the sizes of the removed files
+# do not add up to the missing space yet.
+STATVFS_INTERVAL = 64
 
-    def __key(self):
-        return (self.path)
+# Number of threads that scan directories concurrently. The threads spend
+# most of their time waiting for the disk, so this may exceed the number of
+# CPUs. This only pays off on a cold HDD or on NFS. If the directories are
+# cached, the overhead per directory makes scanning slower than with a single
+# thread. Set this to 1 to scan serially without a thread pool.
+SCAN_THREADS = 8
 
-    def __eq__(x, y):
-        return x.__key() == y.__key()
 
-    def __hash__(self):
-        return hash(self.__key())
-
-
-def process_dir(all_files, dirname, filenames):
+def scan_dir(dirname):
     """Is called by find_files_sorted_by_mtime() for every found directory
        while recursively scanning a parent directory.
 
-       Adds all files given in filenames to all_files. all_files contains only
-       File objects. All fields (path and mtime) of all File objects are set.
+       The directory is read with os.scandir(). Its directory entries already
+       carry the file type and cache the result of stat(), so every found file
+       costs only a single stat() system call. Symbolic links are neither
+       followed nor returned. A directory that cannot be read is treated as
+       empty, just like os.walk() does.
 
        Parameters:
-         all_files (list of File objects): Accumulates all found files.
-         dirname (string):                 Name of the current directory.
-         filenames (list of strings):      Names of all files in the current
-                                           directory.
-    """
-    for filename in filenames:
-        fullpath = os.path.join(dirname, filename)
+         dirname (string): Name of the directory to scan.
 
-        if not os.path.isfile(fullpath):
-            continue
-
-        mtime = os.path.getmtime(fullpath)
-        file = File(fullpath, mtime)
-        all_files.add(file)
+       Returns:
+         The tuple (files, subdirs) where files is a list of (mtime, path,
+         size) tuples for all files in the directory and subdirs a list of the
+         paths of all its subdirectories. size is the space in bytes allocated
+         for the file, i.e. the space removing it frees.
+    """
+    files = []
+    subdirs = []
+    try:
+        entries = os.scandir(dirname)
+    except OSError:
+        return files, subdirs
+
+    with entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                subdirs.append(entry.path)
+            elif entry.is_file(follow_symlinks=False):
+                st = entry.stat(follow_symlinks=False)
+                # st_blocks counts 512-byte units, whatever the block size
+                # of the file system. The allocated size is what removing the
+                # file frees. st_size may be less (a partially used last
+                # block) or more (sparse files).
+                files.append((st.st_mtime, entry.path, st.st_blocks * 512))
+    return files, subdirs
 
 
 def find_files_sorted_by_mtime(directories):
     """Recursively scans the given directories and returns a list of all found
        files.
 
+       The directories are scanned concurrently by SCAN_THREADS threads with
+       scan_dir(). As the threads release the GIL while waiting for the disk,
+       this overlaps the I/O of many directories. If SCAN_THREADS is 1 or
+       less, the directories are scanned serially instead.
+
        Parameters:
          directories (list of strings) - The directories to scan.
 
        Returns:
-         A list of File objects. The list is sorted by the modification time
-         (mtime) of the files with the oldest file at index 0. If no files were
-         found the returned list is empty.
+         A list of (mtime, path, size) tuples, one per found file. mtime is the
+         modification time in seconds since the epoch, size is the space in
+         bytes allocated for the file on the device. The list is arranged as
+         a heap (see the heapq module) ordered by the modification time of the
+         files. The oldest file is at index 0 and heapq.heappop() removes the
+         oldest file. This is cheaper than a full sort as usually only a few
+         of the oldest files are removed. If no files were found the returned
+         list is empty.
     """
-    files=set()
-    for directory in directories:
-        for dirpath, dirnames, filenames in os.walk(directory):
-            process_dir(files, dirpath, filenames)
-    return sorted(files, key=lambda file: file.mtime)
+    # Maps the path of every found file to its (mtime, path, size) tuple.
+    # Files in overlapping directories are found more than once, but must be
+    # listed only once.
+    files = {}
+    if SCAN_THREADS <= 1:
+        pending_dirs = list(directories)
+        while pending_dirs:
+            dir_files, subdirs = scan_dir(pending_dirs.pop())
+            for file in dir_files:
+                files[file[1]] = file
+            pending_dirs.extend(subdirs)
+    else:
+        with concurrent.futures.ThreadPoolExecutor(SCAN_THREADS) as executor:
+            pending = {executor.submit(scan_dir, d) for d in directories}
+            while pending:
+                done, pending = concurrent.futures.wait(
+                    pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    dir_files, subdirs = future.result()
+                    for file in dir_files:
+                        files[file[1]] = file
+                    pending.update(executor.submit(scan_dir, d)
+                                   for d in subdirs)
+    files = list(files.values())
+    heapq.heapify(files)
+    return files
+
+
+def bytes_to_mb(size):
+    """Converts the given size in bytes to whole megabytes (rounded down)."""
+    return size >> 20
 
 
 def avail_space_in_mb(directory):
     """Returns the amount of megabytes that are free (available) in the given
        directory.
 
+       cleanup() itself works in bytes and does not call this function. It is
+       kept for callers of this module and for the tests.
+
        Parameters:
          directory (string) - The directory to check.
     """
     st = os.statvfs(directory)
-    return st.f_frsize*st.f_bavail/1024/1024
+    return bytes_to_mb(st.f_bavail * st.f_frsize)
+
+
+def pop_oldest_files(files, space, max_files):
+    """Pops the oldest files from the given heap until their sizes add up to
+       at least the given space, max_files files were popped or the heap is
+       empty.
+
+       Parameters:
+         files (list of tuples) - A heap of (mtime, path, size) tuples as
+                                  returned by find_files_sorted_by_mtime().
+         space (int) - The space in bytes the popped files should occupy.
+         max_files (int) - The maximal number of files to pop.
+
+       Returns:
+         A list of the paths of the popped files, the oldest file first.
+    """
+    paths = []
+    while space > 0 and len(files) > 0 and len(paths) < max_files:
+        mtime, path, size = heapq.heappop(files)
+        paths.append(path)
+        space -= size
+    return paths
 
 
-def cleanup(directories, min_avail_space):
+def cleanup(directories, min_avail_space, verbose=False):
     """Cleans up the given directories until there is at least the given minimal
        amount of space available. The cleanup method is described at the top of
        this script.
@@ -148,30 +217,59 @@ def cleanup(directories, min_avail_space):
                                          up. Must have at least one element.
          min_avail_space (int) - The amount of free space in megabytes that
                                  should be available in the given directory.
+         verbose (bool) - If True, print every removed file. Otherwise print
+                          only a summary at the end.
     """
 
-    if avail_space_in_mb(directories[0]) >= min_avail_space:
-        print("There is enough space available: %d MB" % \
-                avail_space_in_mb(directories[0]))
+    # The fragment size never changes, so only f_bavail must be read again.
+    # Space is compared in bytes to avoid converting every statvfs() result.
+    frsize = os.statvfs(directories[0]).f_frsize
+
+    def read_avail_bytes():
+        return os.statvfs(directories[0]).f_bavail * frsize
+
+    min_avail_bytes = min_avail_space << 20
+    avail_bytes = read_avail_bytes()
+    if avail_bytes >= min_avail_bytes:
+        print("There is enough space available: "
+              f"{bytes_to_mb(avail_bytes)} MB")
         print("No cleanup necessary. Exiting.")
         return
 
-    # all_files contains a list of all Files in path.
+    # all_files contains (mtime, path, size) of all files in directories.
     all_files = find_files_sorted_by_mtime(directories)
 
-    # Delete the oldest file until there is enough space available.
-    while avail_space_in_mb(directories[0]) < min_avail_space and \
-          len(all_files) > 0:
-        file = all_files.pop(0)
-        print("Removing %s" % file.path)
-        os.remove(file.path)
-        print("Space now available: %d MB." % avail_space_in_mb(directories[0]))
+    # Delete the oldest files whose sizes add up to the missing space. Only
+    # then ask the file system again how much space is available: other
+    # processes may have written to the device in the meantime, or a removed
+    # file may not have freed its full size (e.g. if it had further hard
+    # links). If space is still missing, repeat. A batch holds at most
+    # STATVFS_INTERVAL files, so a wrong estimate can never remove many more
+    # files than necessary.
+    missing_bytes = min_avail_bytes - avail_bytes
+    removed_files = 0
+    while missing_bytes > 0 and len(all_files) > 0:
+        paths = pop_oldest_files(all_files, missing_bytes, STATVFS_INTERVAL)
+        # Remove the files one by one, oldest first, so that an error or an
+        # interrupted run never leaves older files behind than removed ones.
+        for path in paths:
+            if verbose:
+                print(f"Removing {path}")
+            _unlink(path)
+            removed_files += 1
+
+        avail_bytes = read_avail_bytes()
+        if verbose:
+            print(f"Space now available: {bytes_to_mb(avail_bytes)} MB.")
+        missing_bytes = min_avail_bytes - avail_bytes
+
+    print(f"Removed {removed_files} files. "
+          f"Space now available: {bytes_to_mb(avail_bytes)} MB.")
 
     # Report if there is not enough space available and no more file to delete.
-    if avail_space_in_mb(directories[0]) < min_avail_space and \
-       len(all_files) == 0:
-        print("There is NOT enough space available: %d MB" % \
-              avail_space_in_mb(directories[0]))
+    if missing_bytes > 0:
+        print("There is NOT enough space available: "
+              f"{bytes_to_mb(avail_bytes)} MB")
         print("And there are no more files to delete.")
 
 
@@ -191,58 +289,62 @@ def check_directories(directories):
          directories that really exist.
     """
     ok_dirs = []
+    # The device of every directory in ok_dirs. A single os.stat() per
+    # directory tells us whether it exists, whether it is a directory and on
+    # which device it is.
+    devices = []
     for d in directories:
-        if not os.path.exists(d):
-            print("'%s' does not exist. Ignoring." % d)
+        try:
+            st = os.stat(d)
+        except OSError:
+            print(f"'{d}' does not exist. Ignoring.")
             continue
 
-        if not os.path.isdir(d):
-            print("'%s' is no directory. Ignoring." % d)
+        if not stat.S_ISDIR(st.st_mode):
+            print(f"'{d}' is no directory. Ignoring.")
             continue
 
         ok_dirs.append(d)
+        devices.append(st.st_dev)
 
     if len(ok_dirs) == 0:
         print("No existing directory given. Exiting.")
         return False, []
 
-    prev_dir = None
-    prev_device = None
-    for d in ok_dirs:
-        current_device = os.stat(d).st_dev
-        if prev_device is not None and current_device != prev_device:
-            print("'%s' and '%s' are not on the same device. Exiting." % \
-                  (d, prev_dir))
+    for i in range(1, len(ok_dirs)):
+        if devices[i] != devices[i - 1]:
+            print(f"'{ok_dirs[i]}' and '{ok_dirs[i - 1]}' are not on the same "
+                  "device. Exiting.")
             return False, []
 
-        prev_dir = d
-        prev_device = current_device
-
     return True, ok_dirs
 
 
-def parse_opts(directory, min_avail_space):
+def parse_opts(directory, min_avail_space, verbose):
     """Parses the command line options passed to this script.
        If this script is called with -h or --help then this method prints the
        usage information to stdout and exits the scripts.
-       Otherwise it returns the directory and minimal available space given on
-       the command line or the default values for both options passed into this
-       method.
+       Otherwise it returns the directory, minimal available space and
+       verbosity given on the command line or the default values for those
+       options passed into this method.
 
        Parameters:
          directory (string):    default value for the directory to clean.
          min_avail_space (int): default value for the desired minimal available
                                 space.
+         verbose (bool):        default value for printing every removed file.
 
        Returns:
-         (directory, min_avail_space) where directory and min_avail_space are
-         the values given on the command line or the default values.
+         (directory, min_avail_space, verbose) where directory,
+         min_avail_space and verbose are the values given on the command line
+         or the default values.
     """
 
     # We use getopt to parse the command line arguments because argparse or
     # optparse are not available on Dreamboxes.
     try:
-        opts, args = getopt.getopt(sys.argv[1:], "hs:", ["help"])
+        opts, args = getopt.getopt(sys.argv[1:], "hs:v",
+                                   ["help", "verbose"])
     except getopt.GetoptError as err:
         print(str(err))
         usage()
@@ -256,10 +358,12 @@ def parse_opts(directory, min_avail_space):
             try:
                 min_avail_space = int(arg)
             except ValueError as err:
-                print("You have given the option %s %s. " \
-                      "But '%s' is not a number." % (opt, arg, arg))
-                print("Run %s --help for help." % sys.argv[0])
+                print(f"You have given the option {opt} {arg}. "
+                      f"But '{arg}' is not a number.")
+                print(f"Run {sys.argv[0]} --help for help.")
                 sys.exit(1)
+        elif opt in ('-v', '--verbose'):
+            verbose = True
         else:
             assert False, "unhandled option"
 
@@ -267,12 +371,12 @@ def parse_opts(directory, min_avail_space):
     if (len(directories) == 0):
         directories = [directory]
 
-    print("You requested to have %d MB available in the following "\
-          "directories:" % min_avail_space)
+    print(f"You requested to have {min_avail_space} MB available in the "
+          "following directories:")
     for dir in directories:
         print(dir)
 
-    return directories, min_avail_space
+    return directories, min_avail_space, verbose
 
 
 def main():
@@ -284,8 +388,13 @@ def main():
     # Per default we want to have 50GB of free space.
     min_avail_space = 50*1024
 
+    # Per default we print only a summary instead of every removed file.
+    verbose = False
+
     # Override defaults with values given on the command line.
-    directories, min_avail_space = parse_opts(default_directory, min_avail_space)
+    directories, min_avail_space, verbose = parse_opts(default_directory,
+                                                       min_avail_space,
+                                                       verbose)
 
     # Check if all given directories are really directories and on the same
     # device. If not, abort.
@@ -294,7 +403,7 @@ def main():
         return 1
 
     # Do the actual cleanup.
-    cleanup(directories, min_avail_space)
+    cleanup(directories, min_avail_space, verbose)
     return 0
 
 
@@ -306,7 +415,7 @@ if __name__ == '__main__':
         import pstats
         profile_filename = 'cleanup.cleanup_profile.txt'
         cProfile.run('main()', profile_filename)
-        statsfile = open('profile_stats.txt', 'wb')
+        statsfile = open('profile_stats.txt', 'w')
         p = pstats.Stats(profile_filename, stream=statsfile)
         stats = p.strip_dir().sort_stats('cumulative')
         stats.print_stats()
@@ -1,10 +1,13 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 
 import unittest
+import io
 import shutil
+import tempfile
 import os
 import cleanup
 import sys
+from unittest import mock
 
 class RedirectStdStreams(object):
     def __init__(self, stdout=None, stderr=None):
@@ -23,12 +26,8 @@ class RedirectStdStreams(object):
 
 class TestCleanup(unittest.TestCase):
 
-    testdir = os.tmpnam()
-
     def setUp(self):
-        if (os.path.exists(self.testdir)):
-            shutil.rmtree(self.testdir)
-        os.makedirs(self.testdir)
+        self.testdir = tempfile.mkdtemp()
 
     def tearDown(self):
         shutil.rmtree(self.testdir)
@@ -40,15 +39,17 @@ class TestCleanup(unittest.TestCase):
         if not os.path.exists(dirname):
             os.makedirs(dirname)
 
+        # Write real data instead of truncating. Sparse files would occupy no
+        # space on many file systems and deleting them would free nothing.
         with open(name, "wb") as file:
-            file.truncate(size * 1024 * 1024)
+            file.write(b'\0' * (size * 1024 * 1024))
 
         os.utime(name, (ts, ts))
 
-    def cleanup(self, size, dirs=None):
+    def cleanup(self, size, dirs=None, opts=(), stdout=None):
         avail_space = cleanup.avail_space_in_mb(self.testdir)
         target_avail_space = avail_space + size
-        sys.argv = [ 'cleanup.py', '-s', str(target_avail_space)]
+        sys.argv = [ 'cleanup.py', '-s', str(target_avail_space)] + list(opts)
 
         if dirs is None:
             sys.argv.append(self.testdir)
@@ -57,7 +58,7 @@ class TestCleanup(unittest.TestCase):
                 sys.argv.append(os.path.join(self.testdir, d))
 
         devnull = open(os.devnull, 'w')
-        with RedirectStdStreams(stdout=devnull, stderr=devnull):
+        with RedirectStdStreams(stdout=stdout or devnull, stderr=devnull):
             return cleanup.main()
 
     def exists(self, path):
@@ -67,7 +68,7 @@ class TestCleanup(unittest.TestCase):
         self.create_file(name = 'foo', size = 4, ts = 1)
         self.create_file(name = 'bar', size = 4, ts = 2)
         exit_code = self.cleanup(size = 8)
-        self.assertEquals(exit_code, 0)
+        self.assertEqual(exit_code, 0)
         self.assertFalse(self.exists('foo'))
         self.assertFalse(self.exists('bar'))
 
@@ -75,7 +76,7 @@ class TestCleanup(unittest.TestCase):
         self.create_file(name = 'foo', size = 4, ts = 1)
         self.create_file(name = 'bar', size = 4, ts = 2)
         exit_code = self.cleanup(size = 10)
-        self.assertEquals(exit_code, 0)
+        self.assertEqual(exit_code, 0)
         self.assertFalse(self.exists('foo'))
         self.assertFalse(self.exists('bar'))
 
@@ -83,7 +84,7 @@ class TestCleanup(unittest.TestCase):
         self.create_file(name = 'foo', size = 4, ts = 1)
         self.create_file(name = 'bar', size = 4, ts = 2)
         exit_code = self.cleanup(size = 6)
-        self.assertEquals(exit_code, 0)
+        self.assertEqual(exit_code, 0)
         self.assertFalse(self.exists('foo'))
         self.assertFalse(self.exists('bar'))
 
@@ -91,7 +92,7 @@ class TestCleanup(unittest.TestCase):
         self.create_file(name = 'foo', size = 4, ts = 1)
         self.create_file(name = 'bar', size = 4, ts = 2)
         exit_code = self.cleanup(size = 4)
-        self.assertEquals(exit_code, 0)
+        self.assertEqual(exit_code, 0)
         self.assertFalse(self.exists('foo'))
         self.assertTrue(self.exists('bar'))
 
@@ -99,7 +100,7 @@ class TestCleanup(unittest.TestCase):
         self.create_file(name = 'foo', size = 4, ts = 1)
         self.create_file(name = 'bar', size = 4, ts = 2)
         exit_code = self.cleanup(size = 0)
-        self.assertEquals(exit_code, 0)
+        self.assertEqual(exit_code, 0)
         self.assertTrue(self.exists('foo'))
         self.assertTrue(self.exists('bar'))
 
@@ -107,7 +108,7 @@ class TestCleanup(unittest.TestCase):
         self.create_file(name = 'foo', size = 4, ts = 1)
         self.create_file(name = 'bar', size = 4, ts = 2)
         exit_code = self.cleanup(size = -10)
-        self.assertEquals(exit_code, 0)
+        self.assertEqual(exit_code, 0)
         self.assertTrue(self.exists('foo'))
         self.assertTrue(self.exists('bar'))
 
@@ -117,7 +118,7 @@ class TestCleanup(unittest.TestCase):
         self.create_file(name = file1, size = 4, ts = 1)
         self.create_file(name = file2, size = 4, ts = 2)
         exit_code = self.cleanup(size = 8, dirs=['d1'])
-        self.assertEquals(exit_code, 0)
+        self.assertEqual(exit_code, 0)
         self.assertFalse(self.exists(file1))
         self.assertTrue(self.exists(file2))
 
@@ -129,7 +130,7 @@ class TestCleanup(unittest.TestCase):
         self.create_file(name = file2, size = 4, ts = 2)
         self.create_file(name = file3, size = 4, ts = 3)
         exit_code = self.cleanup(size = 8, dirs=['d1', file3])
-        self.assertEquals(exit_code, 0)
+        self.assertEqual(exit_code, 0)
         self.assertFalse(self.exists(file1))
         self.assertTrue(self.exists(file2))
         self.assertTrue(self.exists(file3))
@@ -138,8 +139,18 @@ class TestCleanup(unittest.TestCase):
         file1 = os.path.join('d1', 'foo')
         self.create_file(name = file1, size = 4, ts = 1)
         exit_code = self.cleanup(size = 8, dirs=['d1', 'd2'])
-        self.assertEquals(exit_code, 0)
+        self.assertEqual(exit_code, 0)
+        self.assertFalse(self.exists(file1))
+
+    def test_overlapping_directories_on_command_line(self):
+        file1 = os.path.join('d1', 'dd1', 'foo')
+        file2 = os.path.join('d1', 'bar')
+        self.create_file(name = file1, size = 4, ts = 1)
+        self.create_file(name = file2, size = 4, ts = 2)
+        exit_code = self.cleanup(size = 6, dirs=['d1', os.path.dirname(file1)])
+        self.assertEqual(exit_code, 0)
         self.assertFalse(self.exists(file1))
+        self.assertFalse(self.exists(file2))
 
     def test_subdirs_are_not_deleted(self):
         file1 = os.path.join('d1', 'foo')
@@ -147,17 +158,111 @@ class TestCleanup(unittest.TestCase):
         self.create_file(name = file1, size = 4, ts = 1)
         self.create_file(name = file2, size = 4, ts = 2)
         exit_code = self.cleanup(size = 8)
-        self.assertEquals(exit_code, 0)
+        self.assertEqual(exit_code, 0)
         self.assertFalse(self.exists(file1))
         self.assertFalse(self.exists(file2))
         self.assertTrue(self.exists(os.path.dirname(file1)))
         self.assertTrue(self.exists(os.path.dirname(file2)))
 
+    def test_subdirs_are_scanned_without_thread_pool(self):
+        file1 = os.path.join('d1', 'foo')
+        file2 = os.path.join('d1', 'dd1', 'quuz')
+        file3 = os.path.join('d1', 'dd1', 'bar')
+        self.create_file(name = file1, size = 4, ts = 1)
+        self.create_file(name = file2, size = 4, ts = 2)
+        self.create_file(name = file3, size = 4, ts = 3)
+        scan_threads = cleanup.SCAN_THREADS
+        cleanup.SCAN_THREADS = 1
+        try:
+            exit_code = self.cleanup(size = 8)
+        finally:
+            cleanup.SCAN_THREADS = scan_threads
+        self.assertEqual(exit_code, 0)
+        self.assertFalse(self.exists(file1))
+        self.assertFalse(self.exists(file2))
+        self.assertTrue(self.exists(file3))
+
+    def test_cleanup_continues_if_removed_files_freed_too_little(self):
+        # The hard link outside of the cleaned up directory keeps the data of
+        # the oldest file on the device, so removing it frees nothing.
+        file1 = os.path.join('d1', 'foo')
+        file2 = os.path.join('d1', 'bar')
+        self.create_file(name = file1, size = 4, ts = 1)
+        self.create_file(name = file2, size = 4, ts = 2)
+        os.link(os.path.join(self.testdir, file1),
+                os.path.join(self.testdir, 'foo_link'))
+        exit_code = self.cleanup(size = 4, dirs=['d1'])
+        self.assertEqual(exit_code, 0)
+        self.assertFalse(self.exists(file1))
+        self.assertFalse(self.exists(file2))
+        self.assertTrue(self.exists('foo_link'))
+
+    def test_small_files_do_not_cause_newer_files_to_be_removed(self):
+        # Each small file occupies a whole block, so removing 300 of them
+        # frees more than the at most 1 MB that is missing. Counting only
+        # their 100 bytes each would plan the removal of the big file, too.
+        for i in range(300):
+            name = os.path.join(self.testdir, f"small{i}")
+            with open(name, "wb") as file:
+                file.write(b'\0' * 100)
+            os.utime(name, (i + 1, i + 1))
+        self.create_file(name = 'big.ts', size = 8, ts = 1000)
+        exit_code = self.cleanup(size = 1)
+        self.assertEqual(exit_code, 0)
+        self.assertFalse(self.exists('small0'))
+        self.assertTrue(self.exists('big.ts'))
+
+    def test_removed_files_are_printed_only_if_verbose(self):
+        self.create_file(name = 'foo', size = 4, ts = 1)
+        self.create_file(name = 'bar', size = 4, ts = 2)
+        output = io.StringIO()
+        exit_code = self.cleanup(size = 4, stdout=output)
+        self.assertEqual(exit_code, 0)
+        self.assertNotIn('Removing', output.getvalue())
+        self.assertIn('Removed 1 files.', output.getvalue())
+
+        output = io.StringIO()
+        exit_code = self.cleanup(size = 4, opts=['-v'], stdout=output)
+        self.assertEqual(exit_code, 0)
+        self.assertIn(f"Removing {os.path.join(self.testdir, 'bar')}",
+                      output.getvalue())
+
+    def test_exits_when_directories_are_on_different_devices(self):
+        file1 = os.path.join('d1', 'foo')
+        file2 = os.path.join('d2', 'bar')
+        file3 = os.path.join('d3', 'quuz')
+        self.create_file(name = file1, size = 4, ts = 1)
+        self.create_file(name = file2, size = 4, ts = 2)
+        self.create_file(name = file3, size = 4, ts = 3)
+
+        # Pretend that d3 is on another device than d1 and d2.
+        real_stat = os.stat
+        def fake_stat(path, *args, **kwargs):
+            st = real_stat(path, *args, **kwargs)
+            if os.path.basename(path) != 'd3':
+                return st
+            fields = list(st)
+            fields[2] += 1  # st_dev
+            return os.stat_result(fields)
+
+        output = io.StringIO()
+        with mock.patch('cleanup.os.stat', side_effect=fake_stat):
+            exit_code = self.cleanup(size = 12, dirs=['d1', 'd2', 'd3'],
+                                     stdout=output)
+        self.assertEqual(exit_code, 1)
+        d2 = os.path.join(self.testdir, 'd2')
+        d3 = os.path.join(self.testdir, 'd3')
+        self.assertIn(f"'{d3}' and '{d2}' are not on the same device.",
+                      output.getvalue())
+        self.assertTrue(self.exists(file1))
+        self.assertTrue(self.exists(file2))
+        self.assertTrue(self.exists(file3))
+
     def test_exists_when_no_existing_directory_is_given(self):
         file1 = os.path.join('d1', 'foo')
         self.create_file(name = file1, size = 4, ts = 1)
         exit_code = self.cleanup(size = 8, dirs=['d2'])
-        self.assertEquals(exit_code, 1)
+        self.assertEqual(exit_code, 1)
         self.assertTrue(self.exists(file1))
 
 